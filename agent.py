@@ -1,62 +1,481 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+import openai
 import streamlit as st
 from llama_index.agent import OpenAIAgent
 from llama_index.agent.openai_agent import ChatMessage
 from llama_index.llms import OpenAI
+from llama_index.llms.base import ChatResponse, ChatResponseGen, MessageRole
+from sqlalchemy.exc import DBAPIError, NoSuchColumnError, NoSuchTableError
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
-from common import Conversation, DatabaseProps
-from multi_database import MultiDatabaseToolSpec, TrackingDatabaseToolSpec
+from common import Conversation, DatabaseProps, Message
+from local_engine import LocalQueryError
+from multi_database import (
+    InvalidFederatedQueryError,
+    MultiDatabaseToolSpec,
+    NoSuchDatabaseError,
+    TrackingDatabaseToolSpec,
+)
+from previous_results import PreviousResultsToolSpec
 
+# Number of times the agent is allowed to retry after an error it can fix by itself
+AGENT_AUTO_RETRY_COUNT = 3
 
-@st.cache_resource(show_spinner="Loading LLM...")
-def get_llm(model: str, api_key: str):
-    # API key is a parameter here to force invalidate the cache whenever the API key is changed
-    _ = api_key
-    return OpenAI(model=model)
+# Limits of the agents kept in memory by AgentManager, for all sessions of the server process
+MAX_CACHED_AGENTS = 32
+CACHED_AGENT_TTL_SECONDS = 60 * 60
+MAX_CACHED_AGENTS_MEMORY_USAGE = 256 * 1024 * 1024
 
+# Errors returned by the LLM endpoint when it is overloaded, so the request is retried after a while
+RETRYABLE_LLM_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
 
-@st.cache_resource(show_spinner="Connecting to database...")
-def get_database_spec(database_id: str) -> TrackingDatabaseToolSpec:
-    database: DatabaseProps = st.session_state.databases[database_id]
+# Tools that the fast model is allowed to call when routing is enabled
+FAST_MODEL_TOOLS = ["list_databases", "list_tables", "describe_tables", "list_previous_results"]
+
+# Tools whose output is usually followed by more metadata steps, the fast model is skipped after any other step
+FAST_MODEL_AFTER_TOOLS = ["list_databases", "list_tables", "list_previous_results"]
+
+logger = logging.getLogger(__name__)
+
+
+class RoutingOpenAI(OpenAI):
+    """Sends tool selection and metadata steps to a fast model, and escalates to the configured model
+    for SQL generation, the final answer, or whenever the output of the fast model is not valid.
+    """
+
+    fast_model: str
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        start = time.perf_counter()
+        response, reason = self._try_fast_model(messages, **kwargs)
+
+        if response is None:
+            response = super().chat(messages, **kwargs)
+
+        self._log_route(response, reason, start)
+        return response
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        start = time.perf_counter()
+        response, reason = self._try_fast_model(messages, **kwargs)
+
+        if response is None:
+            # Only the configured model is streamed, as the fast model never produces the final answer
+            self._log_route(None, reason, start)
+            return super().stream_chat(messages, **kwargs)
+
+        self._log_route(response, reason, start)
+
+        def gen() -> ChatResponseGen:
+            yield ChatResponse(message=response.message, raw=response.raw, delta="")
+
+        return gen()
+
+    def _try_fast_model(self, messages: Sequence[ChatMessage], **kwargs: Any) -> Tuple[Optional[ChatResponse], str]:
+        """Returns the response of the fast model if it can be used, and the reason for the routing decision."""
+
+        reason = self._get_skip_reason(messages)
+        if reason:
+            return None, reason
+
+        try:
+            response = super().chat(messages, **{**kwargs, "model": self.fast_model})
+        except RETRYABLE_LLM_ERRORS:
+            # Escalating would send another request to an overloaded endpoint, so let the caller back off instead
+            raise
+        except openai.error.OpenAIError as e:
+            return None, f"fast model failed with {type(e).__name__}"
+
+        reason = self._validate_fast_response(response, kwargs.get("functions") or [])
+
+        return (None if reason else response), reason
+
+    def _get_skip_reason(self, messages: Sequence[ChatMessage]) -> str:
+        """Returns the reason for not trying the fast model when its output would most likely be escalated,
+        or an empty string if it should be tried.
+        """
+
+        if not messages:
+            return ""
+
+        last_message = messages[-1]
+        if last_message.role == MessageRole.FUNCTION:
+            tool_name = last_message.additional_kwargs.get("name")
+            if tool_name not in FAST_MODEL_AFTER_TOOLS:
+                return f"after {tool_name}"
+
+        elif last_message.role == MessageRole.USER:
+            # Tables were already explored in this conversation, so the question probably leads straight to SQL
+            if any(m.role == MessageRole.FUNCTION for m in messages[:-1]):
+                return "follow-up question"
+
+        elif last_message.role == MessageRole.SYSTEM:
+            # Errors are fed back as system messages, and fixing them usually means rewriting SQL
+            return "after error"
+
+        return ""
+
+    def _validate_fast_response(self, response: ChatResponse, functions: List[dict]) -> str:
+        """Returns the reason for escalating the response to the configured model, or an empty string if it is valid."""
 
+        function_call = response.message.additional_kwargs.get("function_call")
+        if function_call is None:
+            return "final answer"
+
+        name = function_call.get("name")
+        function = next((f for f in functions if f["name"] == name), None)
+        if function is None:
+            return f"unknown tool {name}"
+
+        if name not in FAST_MODEL_TOOLS:
+            return f"calls {name}"
+
+        try:
+            arguments = json.loads(function_call.get("arguments") or "{}")
+        except json.JSONDecodeError:
+            return f"invalid arguments for {name}"
+
+        required = function.get("parameters", {}).get("required", [])
+        if not isinstance(arguments, dict) or any(arg not in arguments for arg in required):
+            return f"invalid arguments for {name}"
+
+        return ""
+
+    def _log_route(self, response: Optional[ChatResponse], reason: str, start: float) -> None:
+        elapsed = time.perf_counter() - start
+
+        if response is None:
+            logger.info("Escalated to %s (%s), streaming started after %.2fs", self.model, reason, elapsed)
+        elif reason:
+            logger.info("Escalated to %s (%s) in %.2fs", self.model, reason, elapsed)
+        else:
+            function_name = response.message.additional_kwargs["function_call"]["name"]
+            logger.info("Routed %s to %s in %.2fs", function_name, self.fast_model, elapsed)
+
+
+def create_llm(model: str, fast_model: str = "", **kwargs) -> OpenAI:
+    if fast_model:
+        return RoutingOpenAI(model=model, fast_model=fast_model, **kwargs)
+
+    return OpenAI(model=model, **kwargs)
+
+
+def create_database_spec(
+    database_id: str, uri: str, session_setup: Optional[List[str]] = None, read_only: bool = False
+) -> TrackingDatabaseToolSpec:
     db_spec = TrackingDatabaseToolSpec(
-        uri=database.uri,
+        uri=uri,
     )
 
     # Set the database name for query tracking
     db_spec.database_name = database_id
 
+    db_spec.set_session_options(session_setup, read_only)
+
     return db_spec
 
 
-def database_spec_handler(database, query, items):
+def create_tool_specs(
+    database_specs: Dict[str, TrackingDatabaseToolSpec],
+    messages: List[Message],
+    handler: Optional[Callable[[str, str, Iterable, List[str]], None]] = None,
+    sample_percent: float = 0.0,
+) -> Tuple[MultiDatabaseToolSpec, PreviousResultsToolSpec]:
+    # Keep the results of earlier queries so that follow-up questions can be answered locally
+    previous_results_tools = PreviousResultsToolSpec(handler=handler)
+    for message in messages:
+        # Results of conversations from older backups do not include their column names
+        for database, query, results, *columns in message.query_results:
+            previous_results_tools.add_result(database, query, results, columns[0] if columns else None)
+
+    def tracking_handler(database, query, items, columns):
+        if handler:
+            handler(database, query, items, columns)
+        previous_results_tools.add_result(database, query, items, columns)
+
+    # Set a handler that can be called whenever a query is executed
+    database_tools = MultiDatabaseToolSpec(handler=tracking_handler, sample_percent=sample_percent)
+
+    # Create tools
+    for database_id, db_spec in database_specs.items():
+        database_tools.add_database_tool_spec(database_id, db_spec)
+
+    return database_tools, previous_results_tools
+
+
+def create_agent(
+    llm: OpenAI,
+    database_tools: MultiDatabaseToolSpec,
+    previous_results_tools: PreviousResultsToolSpec,
+    messages: List[Message],
+) -> OpenAIAgent:
+    # Tools are bound to the specs, so databases can be added to or removed from database_tools later on
+    tools = database_tools.to_tool_list() + previous_results_tools.to_tool_list()
+
+    # Load chat history from the conversation's messages
+    chat_history = list(map(lambda m: ChatMessage(role=m.role, content=m.content), messages))
+
+    # Create the Agent with our tools
+    return OpenAIAgent.from_tools(tools, llm=llm, chat_history=chat_history)
+
+
+class CachedAgent:
+    agent: OpenAIAgent
+    database_tools: MultiDatabaseToolSpec
+    previous_results_tools: PreviousResultsToolSpec
+
+    # Used to detect conversations that were replaced (e.g. restored from a backup) or forced to be recreated
+    conversation_object_id: int
+    last_update_timestamp: float
+
+    last_used: float
+    memory_usage: int
+
+    def __init__(
+        self,
+        agent: OpenAIAgent,
+        database_tools: MultiDatabaseToolSpec,
+        previous_results_tools: PreviousResultsToolSpec,
+        conversation: Conversation,
+    ) -> None:
+        self.agent = agent
+        self.database_tools = database_tools
+        self.previous_results_tools = previous_results_tools
+
+        self.conversation_object_id = id(conversation)
+        self.last_update_timestamp = conversation.last_update_timestamp
+
+        self.last_used = time.monotonic()
+        self.memory_usage = 0
+
+    def is_valid_for(self, conversation: Conversation) -> bool:
+        return (
+            self.conversation_object_id == id(conversation)
+            and self.last_update_timestamp == conversation.last_update_timestamp
+        )
+
+    def update_memory_usage(self) -> int:
+        """Estimates the memory used by the chat history and the previous results, in bytes."""
+
+        history_size = sum(len(str(m.content or "")) for m in self.agent.chat_history)
+        self.memory_usage = history_size + self.previous_results_tools.engine.memory_usage()
+        return self.memory_usage
+
+
+class AgentManager:
+    """Keeps the agents of all sessions in this process, bounded by count, idle time, and estimated memory usage.
+    The least recently used agents are evicted first.
+    """
+
+    agents: "OrderedDict[Hashable, CachedAgent]"
+
+    def __init__(
+        self,
+        max_agents: int = MAX_CACHED_AGENTS,
+        ttl: float = CACHED_AGENT_TTL_SECONDS,
+        max_memory_usage: int = MAX_CACHED_AGENTS_MEMORY_USAGE,
+    ) -> None:
+        self.max_agents = max_agents
+        self.ttl = ttl
+        self.max_memory_usage = max_memory_usage
+
+        self.agents = OrderedDict()
+        self.memory_usage = 0
+        self.lock = Lock()
+
+    def get_agent(
+        self,
+        key: Hashable,
+        conversation: Conversation,
+        llm: OpenAI,
+        database_specs: Dict[str, TrackingDatabaseToolSpec],
+        handler: Optional[Callable[[str, str, Iterable, List[str]], None]] = None,
+    ) -> Tuple[OpenAIAgent, MultiDatabaseToolSpec]:
+        """Returns the cached agent of a conversation after updating its LLM and databases, or creates a new one.
+        The database tools of the agent are returned along with it, so that a session can be opened on them.
+        """
+
+        # Conversations restored from older backups do not have a sample percentage
+        sample_percent = getattr(conversation, "sample_percent", 0.0)
+
+        with self.lock:
+            self._evict_expired()
+
+            cached = self.agents.get(key)
+            if cached is not None and cached.is_valid_for(conversation):
+                self._update(cached, llm, database_specs, sample_percent)
+                self._touch(key, cached)
+                return cached.agent, cached.database_tools
+
+        # Replaying the previous results can take a while, so build the agent without blocking other sessions
+        database_tools, previous_results_tools = create_tool_specs(
+            database_specs, conversation.messages, handler, sample_percent
+        )
+        agent = create_agent(llm, database_tools, previous_results_tools, conversation.messages)
+        cached = CachedAgent(agent, database_tools, previous_results_tools, conversation)
+
+        with self.lock:
+            self._remove(key)
+            self.agents[key] = cached
+            self._touch(key, cached)
+            return agent, database_tools
+
+    def _touch(self, key: Hashable, cached: CachedAgent) -> None:
+        cached.last_used = time.monotonic()
+        self.agents.move_to_end(key)
+
+        # Only the accessed agent can have changed since the last call
+        self.memory_usage -= cached.memory_usage
+        self.memory_usage += cached.update_memory_usage()
+
+        self._evict_over_limits()
+
+    def _update(
+        self,
+        cached: CachedAgent,
+        llm: OpenAI,
+        database_specs: Dict[str, TrackingDatabaseToolSpec],
+        sample_percent: float,
+    ) -> None:
+        # Update the agent in place instead of replaying the whole chat history into a new one
+        cached.agent._llm = llm
+
+        database_tools = cached.database_tools
+        database_tools.sample_percent = sample_percent
+
+        for database_id in [d for d in database_tools.database_specs if d not in database_specs]:
+            database_tools.remove_database(database_id)
+
+        for database_id, db_spec in database_specs.items():
+            if database_tools.database_specs.get(database_id) is not db_spec:
+                database_tools.add_database_tool_spec(database_id, db_spec)
+
+    def _remove(self, key: Hashable) -> None:
+        cached = self.agents.pop(key, None)
+        if cached is not None:
+            # The agent may still be used by a turn in progress, so its engine is closed once it is garbage collected
+            self.memory_usage -= cached.memory_usage
+
+    def _evict_expired(self) -> None:
+        expired_before = time.monotonic() - self.ttl
+
+        # Agents are ordered by last use, so stop at the first one that has not expired
+        while self.agents:
+            key, cached = next(iter(self.agents.items()))
+            if cached.last_used >= expired_before:
+                break
+
+            self._remove(key)
+            logger.info("Evicted agent %s after %.0fs of inactivity", key, self.ttl)
+
+    def _evict_over_limits(self) -> None:
+        # Never evict the agent that was just accessed
+        while len(self.agents) > 1 and (
+            len(self.agents) > self.max_agents or self.memory_usage > self.max_memory_usage
+        ):
+            key = next(iter(self.agents))
+            self._remove(key)
+            logger.info("Evicted agent %s, %d agents are using about %d bytes", key, len(self.agents), self.memory_usage)
+
+
+def get_error_feedback(e: Exception) -> Tuple[Optional[BaseException], str]:
+    """Returns the error to report and a system message that tells the agent how to avoid it.
+    If the agent cannot fix the error by itself, the returned error is None.
+    """
+
+    # Give the agent some useful info about the error and what it needs to do to avoid it
+    if isinstance(e, NoSuchColumnError):
+        return e, f"Error: {type(e).__name__}\nUse describe_tables() function to retrieve details about the table."
+
+    if isinstance(e, NoSuchTableError):
+        return e, f"Error: {type(e).__name__}\nUse list_tables() function to get a list of the tables."
+
+    if isinstance(e, NoSuchDatabaseError):
+        return e, f"Error: {type(e).__name__}\nUse list_databases() function to get a list of the databases."
+
+    if isinstance(e, InvalidFederatedQueryError):
+        system_message = f"Error: {type(e).__name__}: {e}\n"
+        system_message += 'Call federated_query() with subqueries like {"table_name": {"database": "...", "query": "..."}}.'
+        return e, system_message
+
+    if isinstance(e, LocalQueryError):
+        system_message = f"Error: {type(e).__name__}\n"
+        system_message += "Queries on previous results and the final query of federated_query() run on SQLite. "
+        system_message += "Use list_previous_results() function to get the tables of previous results."
+        return e, system_message
+
+    if isinstance(e, DBAPIError):
+        return e.orig, f"Error: {type(e.orig).__name__}\nUse describe_tables() function to retrieve details about the table."
+
+    return None, ""
+
+
+@st.cache_resource(show_spinner="Loading LLM...")
+def get_llm(model: str, api_key: str, fast_model: str = ""):
+    # API key is a parameter here to force invalidate the cache whenever the API key is changed
+    _ = api_key
+    return create_llm(model, fast_model)
+
+
+@st.cache_resource(show_spinner="Connecting to database...")
+def get_database_spec(database_id: str) -> TrackingDatabaseToolSpec:
+    database: DatabaseProps = st.session_state.databases[database_id]
+
+    return create_database_spec(database_id, database.uri)
+
+
+def database_spec_handler(database, query, items, columns):
     conversation = st.session_state.conversations[st.session_state.current_conversation]
-    conversation.query_results_queue.append((database, query, items))
+    conversation.query_results_queue.append((database, query, items, columns))
 
 
-@st.cache_resource(show_spinner="Creating agent...")
-def get_agent(conversation_id: str, last_update_timestamp: float):
-    # Used for invalidating the cache when we want to force create a new agent
-    _ = last_update_timestamp
+@st.cache_resource
+def get_agent_manager() -> AgentManager:
+    # A single manager is shared between all sessions, so that the limits apply to the whole process
+    return AgentManager()
+
+
+def get_agent_key(conversation_id: str) -> Tuple[str, str]:
+    # Conversations are stored per session, so different sessions can have conversations with the same id
+    return get_script_run_ctx().session_id, conversation_id
+
+
+def get_agent(conversation_id: str, last_update_timestamp: float) -> Tuple[OpenAIAgent, MultiDatabaseToolSpec]:
+    """Returns the agent of a conversation and its database tools.
+    Use database_tools.session() to keep one connection per database open for a single agent turn.
+    """
 
     conversation: Conversation = st.session_state.conversations[conversation_id]
 
-    # Set a handler that can be called whenever a query is executed
-    database_tools = MultiDatabaseToolSpec(handler=database_spec_handler)
+    # Changing the timestamp forces creating a new agent
+    _ = last_update_timestamp
 
-    # Create tools
+    database_specs = dict()
     for database_id in conversation.database_ids:
+        database: DatabaseProps = st.session_state.databases[database_id]
         db_spec = get_database_spec(database_id)
-        database_tools.add_database_tool_spec(database_id, db_spec)
 
-    tools = database_tools.to_tool_list()
+        # Settings restored from older backups do not have the session options
+        # Changed setup statements are applied to new connections, the read-only option to the next session
+        db_spec.set_session_options(database.get_session_statements(), getattr(database, "read_only", False))
 
-    # Load chat history from the conversation's messages
-    chat_history = list(map(lambda m: ChatMessage(role=m.role, content=m.content), conversation.messages))
+        database_specs[database_id] = db_spec
 
     # Create an LLM with the specified model
-    llm = get_llm(conversation.agent_model, st.session_state.openai_key)
+    # Conversations restored from older backups do not have a fast model
+    llm = get_llm(conversation.agent_model, st.session_state.openai_key, getattr(conversation, "fast_model", ""))
 
-    # Create the Agent with our tools
-    agent = OpenAIAgent.from_tools(tools, llm=llm, chat_history=chat_history)
+    return get_agent_manager().get_agent(
+        get_agent_key(conversation_id), conversation, llm, database_specs, handler=database_spec_handler
+    )
 
-    return agent
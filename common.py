@@ -5,14 +5,29 @@ from typing import Dict, List, Tuple
 import openai
 import streamlit as st
 
+from conversation_index import ConversationIndex
+
 
 class DatabaseProps:
     id: str
     uri: str
 
-    def __init__(self, id, uri) -> None:
+    # SQL statements separated by semicolons, executed once on every new connection to the database
+    session_setup: str
+
+    # Whether the queries of an agent turn run in a single read-only transaction
+    read_only: bool
+
+    def __init__(self, id, uri, session_setup="", read_only=False) -> None:
         self.id = id
         self.uri = uri
+        self.session_setup = session_setup
+        self.read_only = read_only
+
+    def get_session_statements(self) -> List[str]:
+        # Settings restored from older backups do not have session setup statements
+        session_setup = getattr(self, "session_setup", "")
+        return [statement.strip() for statement in session_setup.split(";") if statement.strip()]
 
     def get_uri_without_password(self) -> str:
         match = re.search("(:(?!\/\/).+@)", self.uri)
@@ -28,7 +43,8 @@ class Message:
     role: str
     content: str
 
-    query_results: List[Tuple[str, list]]
+    # (database, query, results, column names) of every query executed for this message
+    query_results: List[Tuple[str, str, list, List[str]]]
 
     def __init__(self, role, content, query_results=None) -> None:
         self.role = role
@@ -42,14 +58,20 @@ class Conversation:
 
     agent_model: str
 
+    # Optional cheaper model used for tool selection and metadata steps (empty to always use agent_model)
+    fast_model: str
+
     database_ids: List[str]
 
+    # Percentage of a table to sample for approximate answers to aggregate questions (0 for exact answers)
+    sample_percent: float
+
     messages: List[Message]
-    query_results_queue: List[Tuple[str, str, list]]
+    query_results_queue: List[Tuple[str, str, list, List[str]]]
 
-    # Used to invalidate get_agent() cache
-    # Whenever we update the database ids of a conversation, we update this timestamp
-    # so that get_agent() will be re-executed
+    # Used to force get_agent() to create a new agent for this conversation
+    # Changes to the model, the database ids, or the sample percentage are applied to the existing agent,
+    # so they do not need a new timestamp
     last_update_timestamp: float
 
     def __init__(
@@ -58,11 +80,15 @@ class Conversation:
         agent_model: str,
         database_ids: List[str],
         messages: List[Message] = None,
+        fast_model: str = "",
+        sample_percent: float = 0.0,
     ) -> None:
         self.id = id
         self.agent_model = agent_model
+        self.fast_model = fast_model
 
         self.database_ids = list(database_ids)
+        self.sample_percent = sample_percent
 
         self.messages = list(messages) if messages else list()
         self.query_results_queue = list()
@@ -89,6 +115,12 @@ def init_session_state():
     if "current_conversation" not in st.session_state:
         st.session_state.current_conversation: str = ""
 
+    if "conversation_index" not in st.session_state:
+        st.session_state.conversation_index = ConversationIndex()
+
+    if "conversation_page" not in st.session_state:
+        st.session_state.conversation_page: int = 0
+
     if "retry" not in st.session_state:
         st.session_state.retry = None
 
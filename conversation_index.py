@@ -0,0 +1,103 @@
+import re
+import sqlite3
+from datetime import datetime
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+if TYPE_CHECKING:
+    from common import Conversation
+
+
+def build_match_query(search: str) -> str:
+    # Quote every word so that user input can never be parsed as FTS5 syntax, and match word prefixes
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", search))
+
+
+class ConversationIndex:
+    """A full-text index over conversation titles, messages, and generated SQL queries.
+
+    The index is updated incrementally by sync(), which only indexes messages that were added since the last call.
+    """
+
+    connection: sqlite3.Connection
+
+    # Conversation id -> (conversation object id, number of indexed messages)
+    indexed: Dict[str, Tuple[int, int]]
+
+    def __init__(self) -> None:
+        # Session state is shared between Streamlit reruns, which are executed on different threads
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = Lock()
+        self.indexed = dict()
+
+        with self.connection:
+            self.connection.execute("CREATE TABLE conversations (id TEXT PRIMARY KEY, updated_at REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX conversations_updated_at ON conversations (updated_at)")
+            self.connection.execute("CREATE VIRTUAL TABLE documents USING fts5(conversation_id UNINDEXED, content)")
+
+    def sync(self, conversations: Dict[str, "Conversation"]) -> None:
+        """Indexes new conversations and messages, and drops conversations that no longer exist."""
+
+        with self.lock, self.connection:
+            for conversation_id in [c for c in self.indexed if c not in conversations]:
+                self._remove(conversation_id)
+
+            for conversation_id, conversation in conversations.items():
+                object_id, message_count = self.indexed.get(conversation_id, (None, 0))
+
+                if object_id != id(conversation):
+                    # The conversation is new or was replaced (e.g. restored from a backup)
+                    self._remove(conversation_id)
+                    self._add_document(conversation_id, conversation_id)
+                    message_count = 0
+                elif message_count == len(conversation.messages):
+                    continue
+
+                for message in conversation.messages[message_count:]:
+                    self._add_document(conversation_id, message.content)
+
+                    for _, query, *_ in message.query_results:
+                        self._add_document(conversation_id, query)
+
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO conversations (id, updated_at) VALUES (?, ?)",
+                    (conversation_id, datetime.now().timestamp()),
+                )
+                self.indexed[conversation_id] = (id(conversation), len(conversation.messages))
+
+    def count(self, search: str = "") -> int:
+        query, params = self._build_query(search, "COUNT(*)")
+
+        with self.lock:
+            return self.connection.execute(query, params).fetchone()[0]
+
+    def list(self, search: str = "", limit: int = -1, offset: int = 0) -> List[str]:
+        """Returns the ids of the conversations matching the search, most recently updated first."""
+
+        query, params = self._build_query(search, "id")
+        query += " ORDER BY updated_at DESC LIMIT ? OFFSET ?"
+
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query, (*params, limit, offset))]
+
+    def _build_query(self, search: str, columns: str) -> Tuple[str, tuple]:
+        match = build_match_query(search)
+
+        if not match:
+            return f"SELECT {columns} FROM conversations", ()
+
+        return (
+            f"SELECT {columns} FROM conversations WHERE id IN "
+            "(SELECT conversation_id FROM documents WHERE documents MATCH ?)",
+            (match,),
+        )
+
+    def _add_document(self, conversation_id: str, content: str) -> None:
+        self.connection.execute(
+            "INSERT INTO documents (conversation_id, content) VALUES (?, ?)", (conversation_id, str(content))
+        )
+
+    def _remove(self, conversation_id: str) -> None:
+        self.connection.execute("DELETE FROM documents WHERE conversation_id = ?", (conversation_id,))
+        self.connection.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        self.indexed.pop(conversation_id, None)
@@ -0,0 +1,317 @@
+"""Run ChatDB questions without the Streamlit UI.
+
+Usage:
+    python headless.py --databases databases.json batch questions.jsonl --output answers.jsonl
+    python headless.py --databases databases.json serve --port 8000
+
+The databases file maps database identifiers to connection URIs, e.g. {"sales": "postgresql://..."},
+or to objects with session options: {"sales": {"uri": ..., "session_setup": ["SET ..."], "read_only": true}}.
+Each line of a questions file is a JSON object: {"id": ..., "question": ..., "databases": [...], "model": ..., "fast_model": ..., "sample_percent": ...}.
+Only "question" is required; all of the configured databases are used by default.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import openai
+from llama_index.llms.base import ChatMessage, MessageRole
+
+from agent import (
+    AGENT_AUTO_RETRY_COUNT,
+    RETRYABLE_LLM_ERRORS,
+    create_agent,
+    create_database_spec,
+    create_llm,
+    create_tool_specs,
+    get_error_feedback,
+)
+from multi_database import NoSuchDatabaseError, TrackingDatabaseToolSpec
+
+DEFAULT_MODEL = "gpt-3.5-turbo-0613"
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+
+
+class RateLimitBackoff:
+    """Exponential backoff shared by all workers, so that they all pause when one of them is rate limited."""
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.resume_at = 0.0
+        self.lock = Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            delay = self.resume_at - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def trigger(self, attempt: int) -> None:
+        # Add jitter so that the workers do not all resume at the same moment
+        delay = min(self.max_delay, self.base_delay * 2**attempt) * random.uniform(0.5, 1.0)
+
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + delay)
+
+
+class HeadlessRunner:
+    """Answers questions about the configured databases on a pool of worker threads."""
+
+    databases: Dict[str, Union[str, dict]]
+    database_specs: Dict[str, TrackingDatabaseToolSpec]
+
+    def __init__(
+        self,
+        databases: Dict[str, Union[str, dict]],
+        model: str = DEFAULT_MODEL,
+        fast_model: str = "",
+        workers: int = DEFAULT_WORKERS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ) -> None:
+        self.databases = databases
+        self.model = model
+        self.fast_model = fast_model
+        self.max_attempts = max_attempts
+
+        self.database_specs = dict()
+        self.database_specs_lock = Lock()
+
+        self.backoff = RateLimitBackoff()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def get_database_spec(self, database_id: str) -> TrackingDatabaseToolSpec:
+        if database_id not in self.databases:
+            raise NoSuchDatabaseError(f"Database '{database_id}' does not exist.")
+
+        # Engines are shared between all questions, same as the Streamlit resource cache
+        with self.database_specs_lock:
+            if database_id not in self.database_specs:
+                database = self.databases[database_id]
+                if isinstance(database, str):
+                    database = {"uri": database}
+
+                self.database_specs[database_id] = create_database_spec(
+                    database_id, database["uri"], database.get("session_setup"), database.get("read_only", False)
+                )
+
+            return self.database_specs[database_id]
+
+    def ask(self, question: dict) -> dict:
+        """Answers a single question and returns the answer, the executed queries, and timings."""
+
+        result = {
+            "id": None,
+            "question": None,
+            "databases": list(self.databases.keys()),
+            "model": self.model,
+            "fast_model": self.fast_model,
+            "sample_percent": 0.0,
+            "answer": None,
+            "queries": [],
+            "error": None,
+            "attempts": 0,
+        }
+
+        start = time.perf_counter()
+
+        try:
+            if not isinstance(question, dict):
+                raise ValueError(f"A question must be a JSON object, not {type(question).__name__}")
+
+            result["id"] = question.get("id")
+            result["question"] = question.get("question")
+            result["databases"] = question.get("databases") or result["databases"]
+            result["model"] = question.get("model") or result["model"]
+            result["fast_model"] = question.get("fast_model", result["fast_model"])
+            result["sample_percent"] = question.get("sample_percent", result["sample_percent"])
+
+            if not result["question"]:
+                raise ValueError("A question is necessary to run the agent")
+
+            database_specs = {database_id: self.get_database_spec(database_id) for database_id in result["databases"]}
+
+            # Rate limits are handled by the runner, so that all workers back off together
+            llm = create_llm(result["model"], result["fast_model"], max_retries=1)
+
+            while True:
+                self.backoff.wait()
+                result["attempts"] += 1
+                result["queries"] = []
+
+                def handler(database, query, items, columns):
+                    result["queries"].append({"database": database, "query": query, "row_count": len(items)})
+
+                # Use a fresh agent for every attempt to avoid keeping a partial turn in its memory
+                database_tools, previous_results_tools = create_tool_specs(
+                    database_specs, [], handler, result["sample_percent"]
+                )
+                agent = create_agent(llm, database_tools, previous_results_tools, [])
+
+                try:
+                    # Keep one connection per database for all the queries of this question
+                    with database_tools.session():
+                        result["answer"] = self._chat(agent, result["question"])
+                    break
+                except RETRYABLE_LLM_ERRORS:
+                    if result["attempts"] >= self.max_attempts:
+                        raise
+
+                    self.backoff.trigger(result["attempts"] - 1)
+
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+
+        result["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run_batch(self, questions: Iterable[dict]) -> Iterator[dict]:
+        """Answers the questions concurrently, yielding the results in the order they are completed."""
+
+        futures = [self.executor.submit(self.ask, question) for question in questions]
+
+        for future in as_completed(futures):
+            yield future.result()
+
+    def _chat(self, agent, prompt: str) -> str:
+        auto_retry_count = AGENT_AUTO_RETRY_COUNT
+
+        while True:
+            try:
+                return agent.chat(prompt).response
+            except Exception as e:
+                exception, system_message = get_error_feedback(e)
+
+                if exception is None or auto_retry_count == 0:
+                    raise
+
+                # Let the agent know about the error and give it another chance, same as the Chats page
+                agent._memory.put(ChatMessage(content=system_message, role=MessageRole.SYSTEM))
+                auto_retry_count -= 1
+
+
+def read_jsonl(lines: Iterable[str]) -> List[dict]:
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def create_request_handler(runner: HeadlessRunner):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/databases":
+                self._send_json(list(runner.databases.keys()))
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+
+            try:
+                if self.path == "/ask":
+                    question = json.loads(body)
+                    if not isinstance(question, dict):
+                        self.send_error(400, "The request body must be a JSON object")
+                        return
+
+                    self._send_json(runner.executor.submit(runner.ask, question).result())
+                elif self.path == "/batch":
+                    results = runner.run_batch(read_jsonl(body.splitlines()))
+                    self._send("".join(json.dumps(r) + "\n" for r in results), "application/x-ndjson")
+                else:
+                    self.send_error(404)
+            except json.JSONDecodeError as e:
+                self.send_error(400, f"Invalid JSON: {e}")
+
+        def _send_json(self, value):
+            self._send(json.dumps(value), "application/json")
+
+        def _send(self, body: str, content_type: str):
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return RequestHandler
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run ChatDB questions without the Streamlit UI.")
+    parser.add_argument("--databases", required=True, help="JSON file mapping database identifiers to connection URIs")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Default OpenAI model for questions without a model")
+    parser.add_argument("--fast-model", default="", help="Cheaper OpenAI model for tool selection and metadata steps")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of questions to run concurrently")
+    parser.add_argument(
+        "--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Attempts per question when rate limited"
+    )
+    parser.add_argument("--openai-key", default=os.environ.get("OPENAI_API_KEY", ""), help="Defaults to $OPENAI_API_KEY")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = subparsers.add_parser("batch", help="Answer the questions of a JSONL file")
+    batch_parser.add_argument("questions", help="JSONL file with one question per line, or - for stdin")
+    batch_parser.add_argument("--output", "-o", help="JSONL file to write the results to (defaults to stdout)")
+
+    serve_parser = subparsers.add_parser("serve", help="Start a local HTTP API")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+
+    args = parser.parse_args(args)
+
+    if not args.openai_key:
+        parser.error("OpenAI API key not set. Use --openai-key or set OPENAI_API_KEY.")
+
+    openai.api_key = args.openai_key
+
+    # Show routing decisions of the fast model
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+
+    with open(args.databases, encoding="utf-8") as f:
+        databases = json.load(f)
+
+    runner = HeadlessRunner(
+        databases, model=args.model, fast_model=args.fast_model, workers=args.workers, max_attempts=args.max_attempts
+    )
+
+    if args.command == "batch":
+        if args.questions == "-":
+            questions = read_jsonl(sys.stdin)
+        else:
+            with open(args.questions, encoding="utf-8") as f:
+                questions = read_jsonl(f)
+
+        output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        try:
+            for result in runner.run_batch(questions):
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+    elif args.command == "serve":
+        server = ThreadingHTTPServer((args.host, args.port), create_request_handler(runner))
+        print(f"Serving on http://{args.host}:{args.port}", file=sys.stderr)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    runner.executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
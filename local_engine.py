@@ -0,0 +1,136 @@
+import sqlite3
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from threading import Lock
+from typing import Iterable, List, Sequence, Tuple
+
+
+# Actions allowed while running a query, so that only SELECT statements can be executed on the stored tables
+READ_ONLY_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+class LocalQueryError(Exception):
+    """Query failed on the local in-process engine."""
+
+
+def authorize_read_only(action: int, *args) -> int:
+    return sqlite3.SQLITE_OK if action in READ_ONLY_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def adapt_value(value):
+    # SQLite only stores a handful of types natively, so convert everything else to the closest match
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+
+    if isinstance(value, Decimal):
+        return float(value)
+
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+
+    return str(value)
+
+
+def get_column_names(items: Sequence, column_count: int = 0) -> List[str]:
+    """Returns the column names of a result set, falling back to generic names if they are not known."""
+
+    if items:
+        # SQLAlchemy rows keep their column names
+        fields = getattr(items[0], "_fields", None)
+        if fields:
+            return list(fields)
+
+        column_count = column_count or len(items[0])
+
+    return [f"column_{i + 1}" for i in range(column_count)]
+
+
+class LocalQueryEngine:
+    """An in-memory SQLite database used for running queries over result sets that were already fetched."""
+
+    connection: sqlite3.Connection
+
+    def __init__(self) -> None:
+        # The engine can be shared between Streamlit reruns, which are executed on different threads
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = Lock()
+
+    def register_table(self, table_name: str, columns: List[str], rows: Iterable[Sequence]) -> None:
+        """Creates (or replaces) a table holding the given rows."""
+
+        if not columns:
+            raise LocalQueryError(f"Cannot create table '{table_name}' without any columns.")
+
+        table = quote_identifier(table_name)
+
+        # Duplicate column names (e.g. from joins) are not allowed in a table definition
+        unique_columns = []
+        for column in columns:
+            name = str(column)
+            suffix = 1
+            while name in unique_columns:
+                suffix += 1
+                name = f"{column}_{suffix}"
+            unique_columns.append(name)
+
+        column_defs = ", ".join(quote_identifier(c) for c in unique_columns)
+        placeholders = ", ".join("?" * len(unique_columns))
+
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+                    self.connection.execute(f"CREATE TABLE {table} ({column_defs})")
+                    self.connection.executemany(
+                        f"INSERT INTO {table} VALUES ({placeholders})",
+                        (tuple(adapt_value(v) for v in row) for row in rows),
+                    )
+            except sqlite3.Error as e:
+                raise LocalQueryError(str(e)) from e
+
+    def execute(self, query: str) -> Tuple[List[str], List[tuple]]:
+        """Runs a SELECT query and returns the column names and the fetched rows."""
+
+        if query is None:
+            raise ValueError("A query parameter is necessary to filter the data")
+
+        with self.lock:
+            # Tables are only created by register_table, so deny anything that would modify them
+            self.connection.set_authorizer(authorize_read_only)
+            try:
+                cursor = self.connection.execute(query)
+                rows = cursor.fetchall()
+            except sqlite3.DatabaseError as e:
+                if "not authorized" in str(e):
+                    raise LocalQueryError("Only SELECT queries can be executed on the stored results.") from e
+                raise LocalQueryError(str(e)) from e
+            except sqlite3.Error as e:
+                raise LocalQueryError(str(e)) from e
+            finally:
+                self.connection.set_authorizer(None)
+
+        columns = [d[0] for d in cursor.description] if cursor.description else []
+        return columns, rows
+
+    def memory_usage(self) -> int:
+        """Returns the size of the database in bytes."""
+
+        with self.lock:
+            page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+            page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+
+        return page_count * page_size
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
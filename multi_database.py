@@ -1,27 +1,80 @@
-from typing import Callable, Dict, Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from llama_hub.tools.database.base import DatabaseToolSpec
 from llama_index import Document
 from llama_index.readers.base import BaseReader
 from llama_index.tools.tool_spec.base import BaseToolSpec
-from sqlalchemy import text
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
+
+from local_engine import LocalQueryEngine
+from sampling import rewrite_for_sampling
+
+# Name reported to the handler for queries that were executed on the local engine
+FEDERATED_DATABASE_NAME = "federated"
+
+# Upper bound for the number of databases that are queried at the same time by federated_query
+MAX_FEDERATED_WORKERS = 8
+
+# Statements that start a read-only transaction with a consistent snapshot, for the dialects that support it
+READ_ONLY_TRANSACTION_STATEMENTS = {
+    "postgresql": "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY",
+    "mysql": "START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY",
+    "oracle": "SET TRANSACTION READ ONLY",
+}
+
+# Dialects where a failed statement aborts the whole transaction, so statements of a snapshot run in savepoints
+ABORTED_TRANSACTION_DIALECTS = ["postgresql"]
 
 
 class NoSuchDatabaseError(InvalidRequestError):
     """Database does not exist or is not visible to a connection."""
 
 
+class InvalidFederatedQueryError(ValueError):
+    """The subqueries given to federated_query are not in the expected format."""
+
+
+def items_to_documents(items: Iterable) -> List[Document]:
+    # Concatenate each row into a Document, same as DatabaseToolSpec.load_data
+    return [Document(text=", ".join([str(entry) for entry in item])) for item in items]
+
+
 class TrackingDatabaseToolSpec(DatabaseToolSpec):
-    handler: Callable[[str, str, Iterable], None]
+    handler: Callable[[str, str, Iterable, List[str]], None]
     database_name: str
 
+    # Statements executed once on every new connection (e.g. SET search_path)
+    session_setup: Optional[List[str]] = None
+
+    # Whether all queries of a DatabaseSession run in a single read-only transaction
+    read_only: bool = False
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        # The engine only belongs to this database, so the settings can stay on its pooled connections
+        event.listen(self.sql_database.engine, "connect", self._apply_session_setup)
+
     def set_handler(self, func: Callable) -> None:
         self.handler = func
 
     def set_database_name(self, database_name: str) -> None:
         self.database_name = database_name
 
+    def set_session_options(self, session_setup: Optional[List[str]] = None, read_only: bool = False) -> None:
+        if (session_setup or None) != (self.session_setup or None):
+            self.session_setup = session_setup
+
+            # Pooled connections still have the old settings, so they are replaced by new ones
+            self.sql_database.engine.dispose()
+
+        self.read_only = read_only
+
     def load_data(self, query: str) -> List[Document]:
         """Query and load data from the Database, returning a list of Documents.
 
@@ -31,38 +84,128 @@ class TrackingDatabaseToolSpec(DatabaseToolSpec):
         Returns:
             List[Document]: A list of Document objects.
         """
-        documents = []
-        with self.sql_database.engine.connect() as connection:
-            if query is None:
-                raise ValueError("A query parameter is necessary to filter the data")
-            else:
-                result = connection.execute(text(query))
-
-            items = result.fetchall()
-
-            if self.handler:
-                self.handler(self.database_name, query, items)
-
-            for item in items:
-                # fetch each item
-                doc_str = ", ".join([str(entry) for entry in item])
-                documents.append(Document(text=doc_str))
-        return documents
+        columns, items = self.execute(query)
+
+        if self.handler:
+            self.handler(self.database_name, query, items, columns)
+
+        return items_to_documents(items)
+
+    def execute(self, query: str, connection: Optional[Connection] = None) -> Tuple[List[str], list]:
+        """Runs a query without notifying the handler, returning the column names and the fetched rows.
+        A new connection is used unless one is given.
+        """
+
+        if query is None:
+            raise ValueError("A query parameter is necessary to filter the data")
+
+        if connection is None:
+            with self.sql_database.engine.connect() as connection:
+                return self.execute(query, connection)
+
+        result = connection.execute(text(query))
+        return list(result.keys()), result.fetchall()
+
+    def begin(self, connection: Connection) -> None:
+        """Starts a read-only transaction on a connection if enabled."""
+
+        dialect = self.sql_database.engine.dialect.name
+        if self.read_only and dialect in READ_ONLY_TRANSACTION_STATEMENTS:
+            connection.execute(text(READ_ONLY_TRANSACTION_STATEMENTS[dialect]))
+
+    def _apply_session_setup(self, dbapi_connection, connection_record) -> None:
+        if not self.session_setup:
+            return
+
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in self.session_setup:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+        # Keep the settings for the whole session instead of the current transaction
+        dbapi_connection.commit()
+
+
+class DatabaseSession:
+    """Keeps one connection per database open for the duration of an agent turn.
+
+    Connections are opened on first use and are all released by close(). Read-only databases keep a single
+    transaction for the whole turn, the others end their transaction after every statement so that the
+    connection is never left idle in a transaction.
+    """
+
+    database_specs: Dict[str, TrackingDatabaseToolSpec]
+    connections: Dict[str, Connection]
+
+    def __init__(self, database_specs: Dict[str, TrackingDatabaseToolSpec]) -> None:
+        self.database_specs = database_specs
+        self.connections = dict()
+
+        # Connections cannot be used by multiple threads at once (e.g. by federated_query)
+        self.locks: Dict[str, Lock] = dict()
+        self.locks_lock = Lock()
+
+    def execute(self, database: str, query: str) -> Tuple[List[str], list]:
+        spec = self.database_specs[database]
+
+        with self._get_lock(database):
+            connection = self.connections.get(database)
+            if connection is None:
+                connection = spec.sql_database.engine.connect()
+                self.connections[database] = connection
+
+            if not spec.read_only:
+                try:
+                    return spec.execute(query, connection)
+                finally:
+                    connection.rollback()
+
+            if not connection.in_transaction():
+                spec.begin(connection)
+
+            if spec.sql_database.engine.dialect.name not in ABORTED_TRANSACTION_DIALECTS:
+                return spec.execute(query, connection)
+
+            # Roll back only the failed statement, so that the following queries still see the same snapshot
+            with connection.begin_nested():
+                return spec.execute(query, connection)
+
+    def close(self) -> None:
+        for connection in self.connections.values():
+            # Closing a connection rolls back its transaction and returns it to the pool
+            connection.close()
+
+        self.connections.clear()
+
+    def _get_lock(self, database: str) -> Lock:
+        with self.locks_lock:
+            return self.locks.setdefault(database, Lock())
 
 
 class MultiDatabaseToolSpec(BaseToolSpec, BaseReader):
     database_specs: Dict[str, TrackingDatabaseToolSpec]
-    handler: Callable[[str, str, Iterable], None]
+    handler: Callable[[str, str, Iterable, List[str]], None]
 
-    spec_functions = ["load_data", "describe_tables", "list_tables", "list_databases"]
+    # Percentage of the table to sample for approximate aggregates, 0 for exact results
+    sample_percent: float
+
+    # Set while queries are running inside session()
+    database_session: Optional[DatabaseSession]
+
+    spec_functions = ["load_data", "federated_query", "describe_tables", "list_tables", "list_databases"]
 
     def __init__(
         self,
         database_toolspec_mapping: Optional[Dict[str, TrackingDatabaseToolSpec]] = None,
-        handler: Optional[Callable[[str, str, Iterable], None]] = None,
+        handler: Optional[Callable[[str, str, Iterable, List[str]], None]] = None,
+        sample_percent: float = 0.0,
     ) -> None:
         self.database_specs = database_toolspec_mapping or dict()
         self.handler = handler
+        self.sample_percent = sample_percent
+        self.database_session = None
 
         for spec in self.database_specs.values():
             spec.set_handler(self.handler)
@@ -78,6 +221,26 @@ class MultiDatabaseToolSpec(BaseToolSpec, BaseReader):
         tool_spec.set_database_name(database_name)
         self.database_specs[database_name] = tool_spec
 
+    def remove_database(self, database_name: str) -> None:
+        self.database_specs.pop(database_name, None)
+
+    @contextmanager
+    def session(self) -> Iterator[DatabaseSession]:
+        """Runs all queries inside this context on one connection per database, e.g. for a single agent turn."""
+
+        self.database_session = DatabaseSession(self.database_specs)
+        try:
+            yield self.database_session
+        finally:
+            self.database_session.close()
+            self.database_session = None
+
+    def execute(self, database: str, query: str) -> Tuple[List[str], list]:
+        if self.database_session is not None:
+            return self.database_session.execute(database, query)
+
+        return self.database_specs[database].execute(query)
+
     def load_data(self, database: str, query: str) -> List[Document]:
         """Query and load data from the given Database, returning a list of Documents.
 
@@ -92,7 +255,106 @@ class MultiDatabaseToolSpec(BaseToolSpec, BaseReader):
         if database not in self.database_specs:
             raise NoSuchDatabaseError(f"Database '{database}' does not exist.")
 
-        return self.database_specs[database].load_data(query)
+        if self.sample_percent:
+            documents = self._load_sampled_data(database, query)
+            if documents is not None:
+                return documents
+
+        # Database specs can be shared between multiple agents, so use this spec's handler instead of theirs
+        columns, items = self.execute(database, query)
+
+        if self.handler:
+            self.handler(database, query, items, columns)
+
+        return items_to_documents(items)
+
+    def _load_sampled_data(self, database: str, query: str) -> Optional[List[Document]]:
+        """Runs an aggregate query on a sample of its table, returns None if the query cannot be sampled."""
+
+        spec = self.database_specs[database]
+        sampled_query = rewrite_for_sampling(query, spec.sql_database.engine.dialect.name, self.sample_percent)
+        if sampled_query is None:
+            return None
+
+        try:
+            columns, items = self.execute(database, sampled_query.query)
+        except DBAPIError:
+            # Some tables cannot be sampled (e.g. views) or cast to FLOAT, so fall back to the exact query
+            # Inside a session, the failed transaction was already rolled back by DatabaseSession.execute
+            return None
+
+        estimate = sampled_query.estimate(items)
+        if estimate is None:
+            return None
+
+        rows, bounds = estimate
+        if self.handler:
+            # Estimated rows do not include the helper columns of the sampled query
+            self.handler(database, sampled_query.query, rows, columns[: len(sampled_query.functions)])
+
+        documents = [Document(text=sampled_query.describe())]
+        for row, row_bounds in zip(rows, bounds):
+            documents.append(Document(text=sampled_query.format_row(row, row_bounds)))
+
+        return documents
+
+    def federated_query(self, subqueries: Dict[str, Dict[str, str]], query: str) -> List[Document]:
+        """Query multiple databases and combine their results locally, returning a list of Documents.
+        Use this instead of load_data whenever an answer needs data from more than one database.
+        The result of each subquery is stored in a temporary table named after its key,
+        then the final query is executed on those tables using the SQLite dialect.
+
+        Args:
+            subqueries (Dict[str, Dict[str, str]]): A mapping from a temporary table name to
+                a subquery, given as {"database": database name, "query": an SQL query for that database}
+            query (str): an SQLite query to join, filter, or aggregate the temporary tables
+
+        Returns:
+            List[Document]: A list of Document objects.
+        """
+
+        if not isinstance(subqueries, dict) or not subqueries:
+            raise InvalidFederatedQueryError("subqueries must be a non-empty mapping from table names to subqueries")
+
+        for table_name, subquery in subqueries.items():
+            if not isinstance(subquery, dict):
+                raise InvalidFederatedQueryError(
+                    f"The subquery of table '{table_name}' must be an object with 'database' and 'query' keys"
+                )
+
+            database = subquery.get("database")
+            if database not in self.database_specs:
+                raise NoSuchDatabaseError(f"Database '{database}' does not exist.")
+
+            if not isinstance(subquery.get("query"), str) or not subquery["query"]:
+                raise InvalidFederatedQueryError(f"A query is necessary for the subquery of table '{table_name}'")
+
+        # Subqueries go to independent databases, so they can all run at the same time
+        workers = min(len(subqueries), MAX_FEDERATED_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                table_name: executor.submit(self.execute, s["database"], s["query"])
+                for table_name, s in subqueries.items()
+            }
+            results = {table_name: future.result() for table_name, future in futures.items()}
+
+        engine = LocalQueryEngine()
+        try:
+            for table_name, (columns, items) in results.items():
+                # The handler is called from this thread since it may depend on the caller's context
+                if self.handler:
+                    self.handler(subqueries[table_name]["database"], subqueries[table_name]["query"], items, columns)
+
+                engine.register_table(table_name, columns, items)
+
+            columns, items = engine.execute(query)
+        finally:
+            engine.close()
+
+        if self.handler:
+            self.handler(FEDERATED_DATABASE_NAME, query, items, columns)
+
+        return items_to_documents(items)
 
     def describe_tables(self, database: str, tables: Optional[List[str]] = None) -> str:
         """
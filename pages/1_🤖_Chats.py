@@ -3,18 +3,24 @@ import re
 
 import streamlit as st
 from llama_index.llms.base import ChatMessage, MessageRole
-from sqlalchemy.exc import DBAPIError, NoSuchColumnError, NoSuchTableError
 
-from agent import get_agent
+from agent import AGENT_AUTO_RETRY_COUNT, get_agent, get_error_feedback
 from backup import backup_conversation, load_conversation
 from common import Conversation, init_session_state
-from multi_database import NoSuchDatabaseError
 
 st.set_page_config(
     page_title="Chats",
     page_icon="🤖",
 )
 
+# Number of conversations listed on each page of the sidebar
+CONVERSATIONS_PAGE_SIZE = 10
+
+SAMPLE_PERCENT_HELP = (
+    "Aggregate questions on large PostgreSQL, SQL Server, and Oracle tables are answered from a sample of this size, "
+    "with error bounds. Set to 0 for exact answers."
+)
+
 # Initialize session state variables
 init_session_state()
 
@@ -27,6 +33,15 @@ def set_conversation(conversation_id):
     st.session_state.current_conversation = conversation_id
 
 
+def set_conversation_page(page):
+    st.session_state.conversation_page = page
+
+
+def set_sample_percent(conversation_id):
+    conversation = st.session_state.conversations[conversation_id]
+    conversation.sample_percent = st.session_state[f"sample_percent_{conversation_id}"]
+
+
 def retry_chat(prompt: str, stream: bool):
     st.session_state.retry = {"stream": stream, "prompt": prompt}
 
@@ -72,6 +87,18 @@ with st.sidebar:
         conversation_id = st.session_state.current_conversation
         with st.expander(conversation_id):
             # TODO: put fields to update conversation params here and update last_update_timestamp whenever they're submitted
+            st.number_input(
+                "Sample percentage for approximate answers",
+                min_value=0.0,
+                max_value=99.0,
+                # Conversations restored from older backups do not have a sample percentage
+                value=float(getattr(st.session_state.conversations[conversation_id], "sample_percent", 0.0)),
+                help=SAMPLE_PERCENT_HELP,
+                key=f"sample_percent_{conversation_id}",
+                on_change=set_sample_percent,
+                args=[conversation_id],
+            )
+
             with st.empty():
                 if st.button("Backup conversation"):
                     backup_file = json.dumps(backup_conversation(conversation_id))
@@ -85,9 +112,24 @@ with st.sidebar:
         st.divider()
 
     st.markdown("## Select conversation")
-    for conversation_id in st.session_state.conversations.keys():
+    search = st.text_input("Search conversations", on_change=set_conversation_page, args=[0])
+
+    # Only index messages that were added since the last rerun
+    conversation_index = st.session_state.conversation_index
+    conversation_index.sync(st.session_state.conversations)
+
+    page_count = max(1, -(-conversation_index.count(search) // CONVERSATIONS_PAGE_SIZE))
+    page = min(st.session_state.conversation_page, page_count - 1)
+
+    for conversation_id in conversation_index.list(search, CONVERSATIONS_PAGE_SIZE, page * CONVERSATIONS_PAGE_SIZE):
         st.button(conversation_id, on_click=set_conversation, args=[conversation_id])
 
+    if page_count > 1:
+        previous_column, page_column, next_column = st.columns([1, 2, 1])
+        previous_column.button("◀", on_click=set_conversation_page, args=[page - 1], disabled=page == 0)
+        page_column.caption(f"Page {page + 1} of {page_count}")
+        next_column.button("▶", on_click=set_conversation_page, args=[page + 1], disabled=page == page_count - 1)
+
 # Main view
 if not conversation_exists(st.session_state.current_conversation):
     st.title("New conversation")
@@ -96,15 +138,27 @@ if not conversation_exists(st.session_state.current_conversation):
     with st.form("new_conversation_form"):
         conversation_id = st.text_input("Conversation title")
         agent_model = st.text_input("Agent model", value="gpt-3.5-turbo-0613", help="OpenAI model. See https://platform.openai.com/docs/models")
+        fast_model = st.text_input(
+            "Fast model (optional)",
+            help="Cheaper OpenAI model used for listing and describing tables. The agent model is still used for SQL queries and answers.",
+        )
 
         database_ids = st.multiselect("Select databases", tuple(st.session_state.databases.keys()))
 
+        sample_percent = st.number_input(
+            "Sample percentage for approximate answers",
+            min_value=0.0,
+            max_value=99.0,
+            value=0.0,
+            help=SAMPLE_PERCENT_HELP,
+        )
+
         if st.form_submit_button():
             if conversation_id in st.session_state.conversations:
                 st.error("Conversation title has to be unique!", icon="🚨")
             else:
                 st.session_state.conversations[conversation_id] = Conversation(
-                    conversation_id, agent_model, database_ids
+                    conversation_id, agent_model, database_ids, fast_model=fast_model, sample_percent=sample_percent
                 )
                 set_conversation(conversation_id)
 
@@ -127,7 +181,7 @@ else:
         with st.chat_message(message.role):
             st.markdown(message.content)
 
-            for database, query, results in message.query_results:
+            for database, query, results, *_ in message.query_results:
                 display_query(database, query, results)
 
     # Initialize the agent
@@ -161,10 +215,10 @@ else:
         conversation.add_message("user", prompt)
 
         # Retrieve agent
-        agent = get_agent(conversation_id, conversation.last_update_timestamp)
+        agent, database_tools = get_agent(conversation_id, conversation.last_update_timestamp)
 
         # Initialize auto retry count
-        auto_retry_count = 3
+        auto_retry_count = AGENT_AUTO_RETRY_COUNT
         show_retry_buttons = False
 
         # Display assistant response in chat message container
@@ -175,78 +229,62 @@ else:
             exception: str
             system_message: str
 
-            while True:
-                try:
-                    exception = ""
-                    system_message = ""
-
-                    if use_streaming:
-                        # Incrementally display response as it is streamed from the agent
-                        for response in agent.stream_chat(prompt).response_gen:
-                            full_response += response
-                            message_placeholder.markdown(full_response + "▌")
+            # Keep one connection per database for all the queries of this response
+            with database_tools.session():
+                while True:
+                    try:
+                        exception = ""
+                        system_message = ""
+
+                        if use_streaming:
+                            # Incrementally display response as it is streamed from the agent
+                            for response in agent.stream_chat(prompt).response_gen:
+                                full_response += response
+                                message_placeholder.markdown(full_response + "▌")
+                        else:
+                            # Receive the whole response before displaying it
+                            message_placeholder.markdown("*Thinking...*")
+                            full_response = agent.chat(prompt).response
+
+                    except Exception as e:
+                        exception, system_message = get_error_feedback(e)
+
+                        if exception is None:
+                            # This is NOT an exception the agent should see
+
+                            # Show the error to the user and add a "retry" button
+                            full_response = "[System] An error has occurred:\n\n"
+                            full_response += "```" + str(e).replace("\n", "\n\n") + "```"
+
+                            show_retry_buttons = True
                     else:
-                        # Receive the whole response before displaying it
-                        message_placeholder.markdown("*Thinking...*")
-                        full_response = agent.chat(prompt).response
-
-                # Give the agent some useful info about the error and what it needs to do to avoid it
-                except NoSuchColumnError as e:
-                    exception = e
-                    system_message = f"Error: {type(e).__name__}\n"
-                    system_message += "Use describe_tables() function to retrieve details about the table."
-
-                except NoSuchTableError as e:
-                    exception = e
-                    system_message = f"Error: {type(e).__name__}\n"
-                    system_message += "Use list_tables() function to get a list of the tables."
-
-                except NoSuchDatabaseError as e:
-                    exception = e
-                    system_message = f"Error: {type(e).__name__}\n"
-                    system_message += "Use list_databases() function to get a list of the databases."
-
-                except DBAPIError as e:
-                    exception = e.orig
-                    system_message = f"Error: {type(e.orig).__name__}\n"
-                    system_message += "Use describe_tables() function to retrieve details about the table."
-
-                except Exception as e:
-                    # This is NOT an exception the agent should see
-
-                    # Show the error to the user and add a "retry" button
-                    full_response = "[System] An error has occurred:\n\n"
-                    full_response += "```" + str(e).replace("\n", "\n\n") + "```"
-
-                    show_retry_buttons = True
-                else:
-                    if full_response == "":
-                        # Something wrong happened
-                        full_response = "[System] An error has occurred, possibly related to streaming."
-                        show_retry_buttons = True
-
-                if exception:
-                    # Let the agent know about the error
-                    agent._memory.put(
-                        ChatMessage(
-                            content=system_message,
-                            role=MessageRole.SYSTEM,
+                        if full_response == "":
+                            # Something wrong happened
+                            full_response = "[System] An error has occurred, possibly related to streaming."
+                            show_retry_buttons = True
+
+                    if exception:
+                        # Let the agent know about the error
+                        agent._memory.put(
+                            ChatMessage(
+                                content=system_message,
+                                role=MessageRole.SYSTEM,
+                            )
                         )
-                    )
 
-                    # Give the agent another chance to try the tool that was recommended in the previous error
-                    if auto_retry_count > 0:
-                        auto_retry_count -= 1
-                        continue
+                        # Give the agent another chance to try the tool that was recommended in the previous error
+                        if auto_retry_count > 0:
+                            auto_retry_count -= 1
+                            continue
 
-                    # Show the error to the user
-                    full_response = "[System] An SQL error has occurred:\n\n"
-                    full_response += f'Error type: "{type(exception).__name__}"\n\n'
-                    full_response += "```" + str(exception).replace("\n", "\n\n") + "```"
+                        # Show the error to the user
+                        full_response = "[System] An SQL error has occurred:\n\n"
+                        full_response += f'Error type: "{type(exception).__name__}"\n\n'
+                        full_response += "```" + str(exception).replace("\n", "\n\n") + "```"
 
-                    show_retry_buttons = True
+                        show_retry_buttons = True
 
-                break
+                    break
 
             # Display full message once it is retrieved
             message_placeholder.markdown(full_response)
@@ -257,8 +295,8 @@ else:
 
             # Show expandable elements for every SQL query generated by this prompt
             query_results = []
-            for database, query, results in conversation.query_results_queue:
-                query_results.append((database, query, results))
+            for database, query, results, columns in conversation.query_results_queue:
+                query_results.append((database, query, results, columns))
                 display_query(database, query, results)
 
             conversation.query_results_queue = []
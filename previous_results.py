@@ -0,0 +1,85 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from llama_index import Document
+from llama_index.tools.tool_spec.base import BaseToolSpec
+
+from local_engine import LocalQueryEngine, get_column_names
+from multi_database import items_to_documents
+
+# Name reported to the handler for queries that were executed on previous results
+PREVIOUS_RESULTS_DATABASE_NAME = "previous_results"
+
+
+class PreviousResultsToolSpec(BaseToolSpec):
+    """Keeps the results of earlier queries in a conversation as local tables that can be queried again."""
+
+    engine: LocalQueryEngine
+    tables: Dict[str, Tuple[str, str, List[str], int]]
+
+    # Number of results added so far, including skipped ones, so that table names do not depend on skipped results
+    result_count: int
+    handler: Callable[[str, str, Iterable, List[str]], None]
+
+    spec_functions = ["list_previous_results", "query_previous_results"]
+
+    def __init__(self, handler: Optional[Callable[[str, str, Iterable, List[str]], None]] = None) -> None:
+        self.engine = LocalQueryEngine()
+        self.tables = dict()
+        self.result_count = 0
+        self.handler = handler
+
+    def set_handler(self, func: Callable) -> None:
+        self.handler = func
+
+    def add_result(self, database: str, query: str, items: Iterable, columns: Optional[List[str]] = None) -> None:
+        items = list(items)
+        columns = columns or get_column_names(items)
+        self.result_count += 1
+
+        if not columns:
+            # Nothing to refine in a result without columns (e.g. from a statement that returns no rows)
+            return
+
+        table_name = f"result_{self.result_count}"
+        self.engine.register_table(table_name, columns, items)
+        self.tables[table_name] = (database, query, columns, len(items))
+
+    def list_previous_results(self) -> str:
+        """
+        Returns the tables holding the results of the previous queries in this conversation.
+        Use the query_previous_results endpoint to query them instead of querying the databases again
+        """
+
+        if not self.tables:
+            return "There are no previous results."
+
+        lines = []
+        for table_name, (database, query, columns, row_count) in self.tables.items():
+            lines.append(
+                f"{table_name}: {row_count} rows from database '{database}', "
+                f"columns: ({', '.join(columns)}), query: {query}"
+            )
+
+        return "\n".join(lines)
+
+    def query_previous_results(self, query: str) -> List[Document]:
+        """Query the results of previous queries, returning a list of Documents.
+        Use this for follow-up questions that only filter, sort, limit, or aggregate results that were already retrieved.
+        To get the available tables, use the list_previous_results endpoint
+
+        Args:
+            query (str): an SQLite query on the tables of previous results.
+
+        Returns:
+            List[Document]: A list of Document objects.
+        """
+
+        columns, items = self.engine.execute(query)
+
+        # Allow refining this result again in later questions
+        self.add_result(PREVIOUS_RESULTS_DATABASE_NAME, query, items, columns)
+
+        if self.handler:
+            self.handler(PREVIOUS_RESULTS_DATABASE_NAME, query, items, columns)
+
+        return items_to_documents(items)
@@ -0,0 +1,255 @@
+import math
+import re
+from typing import List, Optional, Tuple
+
+# Sampling clauses of the dialects that support them, the percentage is formatted into them
+SAMPLE_CLAUSES = {
+    "postgresql": "TABLESAMPLE BERNOULLI ({percent})",
+    "mssql": "TABLESAMPLE ({percent} PERCENT)",
+    "oracle": "SAMPLE ({percent})",
+}
+
+# Dialects that sample whole pages instead of single rows, so the error bounds underestimate the actual error
+BLOCK_SAMPLE_DIALECTS = ["mssql"]
+
+# Dialects where the sampling clause comes before the table alias
+SAMPLE_CLAUSE_BEFORE_ALIAS = ["oracle"]
+
+# Results with fewer sampled rows than this are too inaccurate, so the exact query is executed instead
+MIN_SAMPLE_ROWS = 30
+
+# z-score of the 95% confidence interval used for the error bounds
+CONFIDENCE_Z = 1.96
+
+IDENTIFIER = r'(?:"[^"]+"|\[[^\]]+\]|\w+)'
+
+QUERY_PATTERN = re.compile(
+    r"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+"
+    rf"(?P<table>{IDENTIFIER}(?:\.{IDENTIFIER})*)"
+    r"(?:\s+(?:AS\s+)?(?P<alias>(?!(?:WHERE|GROUP|ORDER)\b)\w+))?"
+    r"(?P<rest>\s+(?:WHERE|GROUP\s+BY|ORDER\s+BY)\b.*?)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+AGGREGATE_PATTERN = re.compile(
+    rf"^(?P<function>COUNT|SUM|AVG)\s*\((?P<argument>.*)\)(?:\s+(?:AS\s+)?(?P<alias>{IDENTIFIER}))?$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Aggregates that cannot be estimated from a sample, or statements that make the whole query ineligible
+UNSUPPORTED_PATTERN = re.compile(
+    r"\b(?:MIN|MAX|STDDEV\w*|VAR\w*|PERCENTILE\w*|MEDIAN|LISTAGG|STRING_AGG|ARRAY_AGG|"
+    r"DISTINCT|TOP|JOIN|UNION|INTERSECT|EXCEPT|HAVING|LIMIT|OFFSET|FETCH|OVER|SELECT)\b",
+    re.IGNORECASE,
+)
+
+AGGREGATE_CALL_PATTERN = re.compile(r"\b(?:COUNT|SUM|AVG)\s*\(", re.IGNORECASE)
+
+
+def split_select_list(select: str) -> Optional[List[str]]:
+    """Splits a select list on top-level commas, returns None if its parentheses are not balanced."""
+
+    items = []
+    depth = 0
+    quote = None
+    start = 0
+
+    for i, c in enumerate(select):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth < 0:
+                return None
+        elif c == "," and depth == 0:
+            items.append(select[start:i].strip())
+            start = i + 1
+
+    if depth != 0 or quote:
+        return None
+
+    items.append(select[start:].strip())
+    return items
+
+
+def is_balanced(expression: str) -> bool:
+    return split_select_list(expression) is not None
+
+
+class SampledQuery:
+    """An aggregate query rewritten to run on a sample of its table, along with how to scale its results."""
+
+    query: str
+    table: str
+    percent: float
+
+    # Aggregate function of each selected column, or None for group keys
+    functions: List[Optional[str]]
+
+    # Whether whole pages were sampled instead of single rows
+    block_sampled: bool
+
+    def __init__(
+        self, query: str, table: str, percent: float, functions: List[Optional[str]], block_sampled: bool = False
+    ) -> None:
+        self.query = query
+        self.table = table
+        self.percent = percent
+        self.functions = functions
+        self.block_sampled = block_sampled
+
+    def estimate(self, items: list) -> Optional[Tuple[List[tuple], List[tuple]]]:
+        """Scales the sampled results to the whole table.
+
+        Returns the estimated rows and the 95% error bound of every value (None for group keys),
+        or None if the sample is too small to estimate from.
+        """
+
+        rate = self.percent / 100
+        column_count = len(self.functions)
+
+        if not items or min(row[-1] or 0 for row in items) < MIN_SAMPLE_ROWS:
+            return None
+
+        rows = []
+        bounds = []
+        for item in items:
+            helpers = iter(item[column_count:])
+            row = []
+            row_bounds = []
+
+            for function, value in zip(self.functions, item[:column_count]):
+                if function is None:
+                    row.append(value)
+                    row_bounds.append(None)
+                    continue
+
+                # Helper columns are appended in the same order by rewrite_for_sampling
+                square_sum = float(next(helpers) or 0) if function in ("SUM", "AVG") else 0.0
+                sample_count = float(next(helpers) or 0) if function == "AVG" else 0.0
+
+                if value is None:
+                    row.append(None)
+                    row_bounds.append(None)
+                    continue
+
+                value = float(value)
+                if function == "COUNT":
+                    estimate = value / rate
+                    bound = CONFIDENCE_Z * math.sqrt(estimate * (1 - rate) / rate)
+                elif function == "SUM":
+                    estimate = value / rate
+                    bound = CONFIDENCE_Z * math.sqrt((1 - rate) * square_sum) / rate
+                else:
+                    estimate = value
+                    variance = max(0.0, square_sum - value * value)
+                    bound = CONFIDENCE_Z * math.sqrt(variance / sample_count) if sample_count else None
+
+                row.append(round(estimate) if function == "COUNT" else estimate)
+                row_bounds.append(bound)
+
+            rows.append(tuple(row))
+            bounds.append(tuple(row_bounds))
+
+        return rows, bounds
+
+    def format_row(self, row: tuple, row_bounds: tuple) -> str:
+        values = []
+        for function, value, bound in zip(self.functions, row, row_bounds):
+            if bound is None:
+                values.append(str(value))
+            elif function == "COUNT":
+                values.append(f"{value:,.0f} (±{bound:,.0f})")
+            elif function == "SUM":
+                values.append(f"{value:,.2f} (±{bound:,.2f})")
+            else:
+                values.append(f"{value:g} (±{bound:.3g})")
+
+        return ", ".join(values)
+
+    def describe(self) -> str:
+        if self.block_sampled:
+            # Rows of the same page tend to be similar, which the row-level error bounds do not account for
+            bounds = "a rough error bound, the actual error can be larger since whole pages were sampled"
+        else:
+            bounds = "its 95% error bound"
+
+        return (
+            f"[Approximate] These results were estimated from a {self.percent:g}% sample of table {self.table}. "
+            f"COUNT and SUM values were scaled to the whole table, and every value is followed by {bounds}. "
+            "Groups that are rare in the table may be missing. "
+            "Mention the sampling rate and the error bounds in your answer."
+        )
+
+
+def rewrite_for_sampling(query: str, dialect: str, percent: float) -> Optional[SampledQuery]:
+    """Rewrites a simple single-table aggregate query to run on a sample of the table.
+
+    Only COUNT, SUM, and AVG aggregates (optionally grouped) can be estimated from a sample,
+    so None is returned for any other query, or if the dialect does not support sampling.
+    """
+
+    if dialect not in SAMPLE_CLAUSES or not 0 < percent < 100:
+        return None
+
+    match = QUERY_PATTERN.match(query)
+    if not match:
+        return None
+
+    select = match.group("select")
+    rest = match.group("rest") or ""
+    if UNSUPPORTED_PATTERN.search(select) or UNSUPPORTED_PATTERN.search(rest):
+        return None
+
+    items = split_select_list(select)
+    if not items:
+        return None
+
+    functions = []
+    helpers = []
+    for i, item in enumerate(items):
+        aggregate = AGGREGATE_PATTERN.match(item)
+
+        if not aggregate or not is_balanced(aggregate.group("argument")):
+            if AGGREGATE_CALL_PATTERN.search(item):
+                # Expressions over aggregates (e.g. SUM(a) / COUNT(*)) cannot be scaled
+                return None
+
+            functions.append(None)
+            continue
+
+        function = aggregate.group("function").upper()
+        argument = aggregate.group("argument").strip()
+        functions.append(function)
+
+        if function in ("SUM", "AVG"):
+            square = f"CAST({argument} AS FLOAT) * CAST({argument} AS FLOAT)"
+            helpers.append(f"{function}({square}) AS approx_square_{i}")
+
+        if function == "AVG":
+            helpers.append(f"COUNT({argument}) AS approx_count_{i}")
+
+    if all(f is None for f in functions):
+        return None
+
+    # The number of sampled rows is used to check whether the sample is large enough
+    helpers.append("COUNT(*) AS approx_sample_rows")
+
+    sample_clause = SAMPLE_CLAUSES[dialect].format(percent=f"{percent:g}")
+    table = match.group("table")
+    alias = match.group("alias")
+
+    if not alias:
+        source = f"{table} {sample_clause}"
+    elif dialect in SAMPLE_CLAUSE_BEFORE_ALIAS:
+        source = f"{table} {sample_clause} {alias}"
+    else:
+        source = f"{table} {alias} {sample_clause}"
+
+    rewritten = f"SELECT {', '.join(items + helpers)} FROM {source}{rest}"
+    return SampledQuery(rewritten, table, percent, functions, dialect in BLOCK_SAMPLE_DIALECTS)